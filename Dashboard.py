@@ -2,10 +2,16 @@
 """
 Dashboard Petrobras - Resultados Preliminares (MVP)
 Tema dark + KPIs + Top 10 fornecedores + Análise de Mercado (sem módulo de risco/vigência)
+O comparativo por preset usa sketches (HyperLogLog / quantis): valores aproximados.
 
 @author: rafae
 """
 
+import glob
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
 import pandas as pd
 import streamlit as st
 import plotly.express as px
@@ -111,7 +117,7 @@ def safe_str_series(s: pd.Series) -> pd.Series:
 DEFAULT_CSV_URL = "https://raw.githubusercontent.com/LeoneTCC/Piloto/refs/heads/main/contratos_petrobras.csv"
 
 st.sidebar.markdown("## ⚙️ Controles")
-csv_url = st.sidebar.text_input("CSV (URL raw GitHub)", value=DEFAULT_CSV_URL)
+csv_url = st.sidebar.text_input("CSV (URL, arquivo, pasta ou glob)", value=DEFAULT_CSV_URL)
 
 # Navegação (1 arquivo só)
 st.sidebar.markdown("## Páginas")
@@ -124,8 +130,7 @@ page = st.sidebar.radio(
 # ---------------------------
 # LOAD / CLEAN
 # ---------------------------
-@st.cache_data(show_spinner=False)
-def load_data(url: str) -> pd.DataFrame:
+def read_partition(url: str) -> pd.DataFrame:
     df = pd.read_csv(url, sep=";", encoding="utf-8")
 
     # normalizações defensivas
@@ -165,8 +170,454 @@ def load_data(url: str) -> pd.DataFrame:
 
     return df
 
+# Base particionada: uma exportação por ano / unidade_adm.
+# Aceita URL ou arquivo único, uma pasta (todos os *.csv, recursivo) ou um glob.
+MAX_WORKERS_LOAD = 8
+
+def list_partitions(source: str) -> list:
+    source = source.strip()
+    if source.startswith(("http://", "https://")):
+        return [source]
+    if os.path.isdir(source):
+        return sorted(glob.glob(os.path.join(source, "**", "*.csv"), recursive=True))
+    if any(ch in source for ch in "*?["):
+        return sorted(glob.glob(source, recursive=True))
+    return [source]
+
+def load_partition(path: str) -> dict:
+    """Uma partição: linhas BRL + min/max de fim_vigencia + sketches próprios.
+
+    As linhas ficam ordenadas por fim_vigencia (NaT no fim): recortes de data
+    viram fatias via searchsorted.
+    """
+    part = read_partition(path)
+    brl = (
+        part.loc[part["moeda"] == "R$"]
+        .sort_values("fim_vigencia", na_position="last", kind="stable")
+        .reset_index(drop=True)
+    )
+    brl["preset_mask"] = preset_mask(brl["objeto"])
+    return {
+        "path": path,
+        "df": brl,
+        "n_fim": int(brl["fim_vigencia"].notna().sum()),
+        "fim_min": brl["fim_vigencia"].min() if "fim_vigencia" in brl.columns else pd.NaT,
+        "fim_max": brl["fim_vigencia"].max() if "fim_vigencia" in brl.columns else pd.NaT,
+        "situacoes": set(brl["situacao"].dropna().unique().tolist()),
+        "sketches": sketches_base(brl),
+    }
+
+def assinatura_fonte(source: str) -> tuple:
+    """(caminho, mtime, tamanho) de cada partição local; muda quando um export é atualizado."""
+    assinatura = []
+    for path in list_partitions(source):
+        if os.path.isfile(path):
+            info = os.stat(path)
+            assinatura.append((path, info.st_mtime_ns, info.st_size))
+        else:
+            assinatura.append((path,))
+    return tuple(assinatura)
+
+# cache_resource: os frames são compartilhados (sem cópia/unpickle a cada rerun)
+# e tratados como somente leitura. Partição podada nunca é tocada.
+@st.cache_resource(show_spinner=False, max_entries=2)
+def load_partitions(source: str, assinatura: tuple) -> list:
+    """Lê as partições em paralelo e anota min/max de fim_vigencia (linhas BRL).
+
+    O min/max permite podar partições fora do "Período" sem olhar as linhas.
+    `assinatura` (ver assinatura_fonte) só entra na chave do cache.
+    """
+    paths = [a[0] for a in assinatura]
+    if not paths:
+        return []
+
+    # leitura é I/O (rede/disco) + parser C do pandas -> threads bastam
+    with ThreadPoolExecutor(max_workers=min(MAX_WORKERS_LOAD, len(paths))) as ex:
+        return list(ex.map(load_partition, paths))
+
+def periodo_de(date_range):
+    """(d0, d1) do "Período" selecionado, ou None enquanto o intervalo está incompleto."""
+    if isinstance(date_range, tuple) and len(date_range) == 2:
+        d0 = pd.Timestamp(date_range[0])
+        d1 = pd.Timestamp(date_range[1]) + pd.Timedelta(days=1) - pd.Timedelta(seconds=1)
+        return d0, d1
+    return None
+
+def podar_particoes(partitions: list, periodo) -> list:
+    """Índices das partições cujo [fim_min, fim_max] encosta no período."""
+    if periodo is None:
+        return list(range(len(partitions)))
+    d0, d1 = periodo
+    return [
+        i for i, p in enumerate(partitions)
+        if pd.notna(p["fim_min"]) and p["fim_max"] >= d0 and p["fim_min"] <= d1
+    ]
+
+# ---------------------------
+# SKETCHES (HLL + QUANTIS)
+# ---------------------------
+# Pré-agregação por bucket (mês de fim_vigencia x situação x preset de categoria):
+# cada bucket guarda um HyperLogLog de fornecedores e um sketch de quantis (bins
+# log, estilo DDSketch) de valor_contrato. Ambos são "mergeáveis": HLL -> máximo
+# dos registradores, quantis -> soma das contagens. Servem para comparar todos os
+# presets de uma vez sem rodar um str.contains por preset; os KPIs do recorte
+# atual são exatos, porque a base filtrada já existe para o cubo.
+HLL_P = 12                      # 2^12 registradores (~1,6% de erro padrão)
+HLL_M = 1 << HLL_P
+HLL_BITS = 52                   # bits do hash usados no rho (exatos em float64)
+
+QS_ALPHA = 0.01                 # erro relativo do sketch de quantis (1%)
+QS_GAMMA = (1 + QS_ALPHA) / (1 - QS_ALPHA)
+QS_MAX_VALOR = 1e13             # acima disso cai no último bin
+QS_BINS = int(np.ceil(np.log(QS_MAX_VALOR) / np.log(QS_GAMMA))) + 2  # bin 0 = valores < 1
+
+# presets da página "Análise por objeto"; na carga cada linha ganha um bitmask
+# (coluna preset_mask) com os presets que casam com o objeto
+PRESETS_OBJETO = [
+    "transporte",
+    "manutenção",
+    "serviços",
+    "obra",
+    "engenharia",
+    "equipamento",
+    "tecnologia",
+    "software",
+    "licença",
+    "consultoria",
+    "turbina",
+    "bomba",
+    "válvula",
+]
+
+def preset_mask(objeto: pd.Series) -> np.ndarray:
+    mask = np.zeros(len(objeto), dtype=np.uint16)
+    for k, termo in enumerate(PRESETS_OBJETO):
+        casa = objeto.str.contains(termo, case=False, na=False).to_numpy()
+        mask |= casa.astype(np.uint16) << np.uint16(k)
+    return mask
+
+def _hll_pos(fornecedores: pd.Series):
+    """Índice do registrador e rho (posição do 1º bit 1) de cada fornecedor."""
+    h = pd.util.hash_pandas_object(fornecedores, index=False).to_numpy(dtype=np.uint64)
+    idx = (h >> np.uint64(64 - HLL_P)).astype(np.int64)
+    w = (h & np.uint64((1 << HLL_BITS) - 1)).astype(np.float64)
+    rho = HLL_BITS - np.frexp(w)[1] + 1
+    return idx, rho.astype(np.uint8)
+
+def _qs_bin(valores: pd.Series) -> np.ndarray:
+    v = valores.to_numpy(dtype=np.float64)
+    b = np.zeros(len(v), dtype=np.int64)
+    pos = v >= 1
+    b[pos] = np.ceil(np.log(v[pos]) / np.log(QS_GAMMA)).astype(np.int64) + 1
+    return np.clip(b, 0, QS_BINS - 1)
+
+def _csr(cel: np.ndarray, valores: np.ndarray, largura: int, n: int):
+    """Células (bucket * largura + posição) ordenadas -> (ptr, posição, valor)."""
+    ptr = np.searchsorted(cel // largura, np.arange(n + 1))
+    return ptr, (cel % largura).astype(np.int16), valores
+
+def _csr_take(ptr: np.ndarray, buckets: np.ndarray) -> np.ndarray:
+    """Posições das entradas dos `buckets` num array CSR, sem tocar nos demais."""
+    ini = ptr[buckets]
+    tam = ptr[buckets + 1] - ini
+    total = int(tam.sum())
+    if total == 0:
+        return np.empty(0, dtype=np.int64)
+    return np.repeat(ini - np.cumsum(tam) + tam, tam) + np.arange(total)
+
+def sketches_base(base: pd.DataFrame) -> dict:
+    """Sketches esparsos por bucket (mês de fim_vigencia x situação x preset).
+
+    Preset 0 = todas as linhas, k = PRESETS_OBJETO[k - 1]. Cada bucket guarda só
+    os registradores HLL não nulos e os bins de quantis ocupados (formato CSR),
+    então o tamanho acompanha o número de linhas do bucket, com teto de
+    2^HLL_P + QS_BINS entradas.
+    """
+    mask = base["preset_mask"].to_numpy()
+    linhas = [np.arange(len(base))]
+    presets = [np.zeros(len(base), dtype=np.int64)]
+    for k in range(len(PRESETS_OBJETO)):
+        casa = np.flatnonzero(mask & (1 << k))
+        linhas.append(casa)
+        presets.append(np.full(len(casa), k + 1, dtype=np.int64))
+    linhas = np.concatenate(linhas)
+    presets = np.concatenate(presets)
+
+    mes = base["fim_vigencia"].dt.to_period("M").dt.to_timestamp().to_numpy()[linhas]
+    dims = pd.DataFrame({"mes": mes, "situacao": base["situacao"].to_numpy()[linhas], "preset": presets})
+    codes = dims.groupby(["mes", "situacao", "preset"], dropna=False, sort=False).ngroup().to_numpy()
+    keys = (
+        dims.assign(code=codes)
+        .drop_duplicates("code")
+        .sort_values("code")
+        .drop(columns=["code"])
+        .reset_index(drop=True)
+    )
+    n = len(keys)
+
+    reg, rho = _hll_pos(base["fornecedor"])
+    maximos = pd.Series(rho[linhas]).groupby(codes * HLL_M + reg[linhas]).max()
+    hll_ptr, hll_reg, hll_rho = _csr(maximos.index.to_numpy(), maximos.to_numpy(), HLL_M, n)
+
+    cel, contagens = np.unique(codes * QS_BINS + _qs_bin(base["valor_contrato"])[linhas], return_counts=True)
+    qs_ptr, qs_bin, qs_n = _csr(cel, contagens.astype(np.int32), QS_BINS, n)
+
+    return {
+        "keys": keys,
+        "hll_ptr": hll_ptr, "hll_reg": hll_reg, "hll_rho": hll_rho,
+        "qs_ptr": qs_ptr, "qs_bin": qs_bin, "qs_n": qs_n,
+    }
+
+def hll_estimate(registers: np.ndarray) -> int:
+    m = float(HLL_M)
+    alpha = 0.7213 / (1 + 1.079 / m)
+    e = alpha * m * m / float(np.sum(np.ldexp(1.0, -registers.astype(np.int64))))
+    zeros = int(np.count_nonzero(registers == 0))
+    if e <= 2.5 * m and zeros > 0:
+        e = m * np.log(m / zeros)  # linear counting (cardinalidades pequenas)
+    return int(round(e))
+
+def qs_quantile(counts: np.ndarray, q: float) -> float:
+    n = int(counts.sum())
+    if n == 0:
+        return 0.0
+    i = int(np.searchsorted(np.cumsum(counts), q * (n - 1), side="right"))
+    if i == 0:
+        return 0.0
+    # ponto médio do bin (erro relativo <= QS_ALPHA)
+    return float(2 * QS_GAMMA ** (i - 1) / (QS_GAMMA + 1))
+
+def resumo_valores(fornecedores: int, valores: np.ndarray) -> dict:
+    """KPIs exatos: fornecedores distintos + mediana/P90 do ticket."""
+    p50, p90 = np.quantile(valores, [0.50, 0.90]) if len(valores) else (0.0, 0.0)
+    return {"fornecedores": int(fornecedores), "ticket_p50": float(p50), "ticket_p90": float(p90)}
+
+@st.cache_data(show_spinner=False, max_entries=32)
+def resumo_presets(source: str, assinatura: tuple, date_range, situacao_sel: tuple) -> pd.DataFrame:
+    """Contratos, fornecedores (HLL) e mediana/P90 (sketch) de cada preset.
+
+    Junta os buckets das partições que sobraram da poda. Só as linhas dos meses
+    de borda (período começando/terminando no meio do mês) são lidas; como cada
+    partição está ordenada por fim_vigencia, elas saem de fatias via searchsorted.
+    """
+    partitions = load_partitions(source, assinatura)
+    periodo = periodo_de(date_range)
+    n_presets = len(PRESETS_OBJETO) + 1
+    hll = np.zeros((n_presets, HLL_M), dtype=np.uint8)
+    qs = np.zeros((n_presets, QS_BINS), dtype=np.int64)
+
+    for i in podar_particoes(partitions, periodo):
+        p = partitions[i]
+        sk = p["sketches"]
+        keys = sk["keys"]
+        ok = np.ones(len(keys), dtype=bool)
+        fatias = []
+        if periodo is not None:
+            d0, d1 = periodo
+            # meses cheios = [m0, m1): m0 = 1º início de mês >= d0, m1 = último início de mês <= d1 + 1s
+            m0 = pd.offsets.MonthBegin().rollforward(d0.normalize())
+            m1 = pd.offsets.MonthBegin().rollback(d1 + pd.Timedelta(seconds=1))
+            mes = keys["mes"]
+            ok &= (mes.notna() & (mes >= m0) & (mes < m1)).to_numpy()
+            fim = p["df"]["fim_vigencia"].to_numpy()[:p["n_fim"]]
+            limites = [(d0, m0, "left"), (m1, d1, "right")] if m1 > m0 else [(d0, d1, "right")]
+            for lo, hi, lado in limites:
+                fatias.append((
+                    int(np.searchsorted(fim, lo.to_datetime64(), side="left")),
+                    int(np.searchsorted(fim, hi.to_datetime64(), side=lado)),
+                ))
+        if situacao_sel:
+            ok &= keys["situacao"].isin(situacao_sel).to_numpy()
+
+        preset = keys["preset"].to_numpy()
+        for k in range(n_presets):
+            buckets = np.flatnonzero(ok & (preset == k))
+            e = _csr_take(sk["hll_ptr"], buckets)
+            np.maximum.at(hll[k], sk["hll_reg"][e], sk["hll_rho"][e])
+            e = _csr_take(sk["qs_ptr"], buckets)
+            qs[k] += np.bincount(sk["qs_bin"][e], weights=sk["qs_n"][e], minlength=QS_BINS).astype(np.int64)
+
+        for ini, fim_ in fatias:
+            borda = p["df"].iloc[ini:fim_]
+            if situacao_sel:
+                borda = borda.loc[borda["situacao"].isin(situacao_sel)]
+            if not len(borda):
+                continue
+            reg, rho = _hll_pos(borda["fornecedor"])
+            bins = _qs_bin(borda["valor_contrato"])
+            pm = borda["preset_mask"].to_numpy()
+            for k in range(n_presets):
+                sel = np.ones(len(borda), dtype=bool) if k == 0 else (pm & (1 << (k - 1))) != 0
+                np.maximum.at(hll[k], reg[sel], rho[sel])
+                qs[k] += np.bincount(bins[sel], minlength=QS_BINS)
+
+    contratos = qs.sum(axis=1)
+    return pd.DataFrame({
+        "Categoria (objeto)": ["Todas"] + PRESETS_OBJETO,
+        "Contratos (#)": contratos,
+        "Fornecedores (aprox.)": [hll_estimate(h) if c else 0 for h, c in zip(hll, contratos)],
+        "Mediana (R$)": [qs_quantile(q, 0.50) for q in qs],
+        "P90 (R$)": [qs_quantile(q, 0.90) for q in qs],
+    })
+
+# ---------------------------
+# CROSS-FILTER (drill por clique)
+# ---------------------------
+# Clicar num fornecedor (fig_valor / fig_share) ou num ano (fig_time) vira filtro
+# para os demais gráficos e KPIs. Cada clique é um rerun com os mesmos filtros de
+# sidebar: o recorte já agregado (cubo fornecedor x ano + posições das linhas por
+# fornecedor/ano) vem de um cache compartilhado por chave de filtro, e o drill só
+# restringe o cubo.
+st.session_state.setdefault("drill_fornecedor", None)
+st.session_state.setdefault("drill_ano", None)
+
+def on_select_drill(chart_key: str, campo: str):
+    def _callback():
+        pontos = st.session_state[chart_key].selection.points
+        valor = pontos[0]["x"] if pontos else None
+        if campo == "drill_ano" and valor is not None:
+            valor = int(valor)
+        st.session_state[campo] = valor
+    return _callback
+
+def limpar_drill():
+    st.session_state["drill_fornecedor"] = None
+    st.session_state["drill_ano"] = None
+
+def validar_drill(cube: pd.DataFrame):
+    """Descarta drills que não existem no cubo atual (filtros da sidebar mudaram)."""
+    fornecedor = st.session_state["drill_fornecedor"]
+    ano = st.session_state["drill_ano"]
+    if fornecedor is not None and not (cube["fornecedor"] == fornecedor).any():
+        fornecedor = None
+    if ano is not None and not (cube["ano"] == ano).any():
+        ano = None
+    st.session_state["drill_fornecedor"] = fornecedor
+    st.session_state["drill_ano"] = ano
+    return fornecedor, ano
+
+def mostrar_drill(box, fornecedor, ano):
+    if fornecedor is None and ano is None:
+        return
+    box.markdown("### Seleção nos gráficos")
+    if fornecedor is not None:
+        box.caption(f"Fornecedor: {fornecedor}")
+    if ano is not None:
+        box.caption(f"Ano (início da vigência): {ano}")
+    box.button("Limpar seleção", on_click=limpar_drill)
+
+def build_cube(base: pd.DataFrame, today: pd.Timestamp) -> pd.DataFrame:
+    """Agregados por (fornecedor, ano de início da vigência)."""
+    ano = base["inicio_vigencia"].dt.year if "inicio_vigencia" in base.columns else pd.Series(pd.NA, index=base.index)
+    cols = {
+        "valor_total": ("valor_contrato", "sum"),
+        "n": ("valor_contrato", "size"),
+        "qtd": ("sq_contrato", "count"),
+    }
+    extra = {}
+    if "fim_vigencia" in base.columns:
+        fim = base["fim_vigencia"]
+        extra["ativo"] = fim.notna() & (fim >= today)
+        extra["vence_90"] = extra["ativo"] & (fim <= today + pd.Timedelta(days=90))
+        cols.update(
+            ativos=("ativo", "sum"),
+            venc_90=("vence_90", "sum"),
+            ultimo_fim=("fim_vigencia", "max"),
+            primeiro_inicio=("inicio_vigencia", "min"),
+        )
+    return (
+        base.assign(ano=ano, **extra)
+        .groupby(["fornecedor", "ano"], dropna=False)
+        .agg(**cols)
+        .reset_index()
+    )
+
+def cube_drill(cube: pd.DataFrame, fornecedor=None, ano=None) -> pd.DataFrame:
+    if fornecedor is not None:
+        cube = cube.loc[cube["fornecedor"] == fornecedor]
+    if ano is not None:
+        cube = cube.loc[cube["ano"] == ano]
+    return cube
+
+def agrega_fornecedor(cube: pd.DataFrame) -> pd.DataFrame:
+    cols = {"valor_total": ("valor_total", "sum"), "qtd": ("qtd", "sum")}
+    if "ultimo_fim" in cube.columns:
+        cols.update(ultimo_fim=("ultimo_fim", "max"), primeiro_inicio=("primeiro_inicio", "min"))
+    return cube.groupby("fornecedor", dropna=False).agg(**cols).reset_index()
+
+def filtrar_base(partitions: list, sel_idx: list, periodo, situacao_sel: tuple, keyword: str) -> pd.DataFrame:
+    if sel_idx:
+        df_f = pd.concat([partitions[i]["df"] for i in sel_idx], ignore_index=True)
+    else:
+        df_f = partitions[0]["df"].iloc[0:0].copy()
+
+    # filtro datas
+    if periodo is not None:
+        d0, d1 = periodo
+        if "fim_vigencia" in df_f.columns:
+            df_f = df_f.loc[
+                (df_f["fim_vigencia"].notna())
+                & (df_f["fim_vigencia"] >= d0)
+                & (df_f["fim_vigencia"] <= d1)
+            ]
+
+    # filtro situacao
+    if situacao_sel:
+        df_f = df_f.loc[df_f["situacao"].isin(situacao_sel)]
+
+    # filtro keyword no objeto
+    if keyword:
+        df_f = df_f.loc[df_f["objeto"].str.contains(keyword, case=False, na=False)]
+
+    return df_f.reset_index(drop=True)
+
+# compartilhado entre sessões e somente leitura; a base filtrada em si não fica
+# no cache, só o que o drill consulta
+@st.cache_resource(show_spinner=False, max_entries=32)
+def agregados_filtro(source: str, assinatura: tuple, date_range, situacao_sel: tuple,
+                     keyword: str, cat_query: str, hoje) -> dict:
+    """Cubo, valores e posições por fornecedor/ano de um recorte de filtros.
+
+    `assinatura` (mtime/tamanho dos exports) e `hoje` entram na chave para não
+    servir agregados de uma base ou de um dia anteriores.
+    """
+    partitions = load_partitions(source, assinatura)
+    periodo = periodo_de(date_range)
+    sel_idx = podar_particoes(partitions, periodo)
+    base = filtrar_base(partitions, sel_idx, periodo, situacao_sel, keyword)
+    if cat_query:
+        base = base.loc[base["objeto"].str.contains(cat_query, case=False, na=False)].reset_index(drop=True)
+
+    ano = base["inicio_vigencia"].dt.year if "inicio_vigencia" in base.columns else None
+    return {
+        "cube": build_cube(base, pd.Timestamp(hoje)),
+        "valores": base["valor_contrato"].to_numpy(),
+        "idx_forn": base.groupby("fornecedor").indices,
+        "idx_ano": base.groupby(ano).indices if ano is not None else {},
+        "resumo": resumo_valores(base["fornecedor"].nunique(dropna=True), base["valor_contrato"].to_numpy()),
+    }
+
+def resumo_drill(ag: dict, cube_sel: pd.DataFrame, fornecedor=None, ano=None) -> dict:
+    """Mesmas chaves de `ag["resumo"]`, só com as linhas do drill.
+
+    As linhas saem direto das posições guardadas em `ag`; a base não é varrida.
+    """
+    vazio = np.empty(0, dtype=np.int64)
+    if fornecedor is not None and ano is not None:
+        idx = np.intersect1d(ag["idx_forn"].get(fornecedor, vazio), ag["idx_ano"].get(ano, vazio), assume_unique=True)
+    elif fornecedor is not None:
+        idx = ag["idx_forn"].get(fornecedor, vazio)
+    else:
+        idx = ag["idx_ano"].get(ano, vazio)
+    return resumo_valores(cube_sel.loc[cube_sel["n"] > 0, "fornecedor"].nunique(), ag["valores"][idx])
+
+assinatura = assinatura_fonte(csv_url)
 with st.spinner("Carregando dados..."):
-    df = load_data(csv_url)
+    partitions = load_partitions(csv_url, assinatura)
+
+if not partitions:
+    st.error(f"Nenhum CSV encontrado em: {csv_url}")
+    st.stop()
 
 # ---------------------------
 # HEADER
@@ -181,12 +632,11 @@ st.markdown("<div class='hr'></div>", unsafe_allow_html=True)
 # ---------------------------
 # BASE FILTER (BRL)
 # ---------------------------
-df_brl = df.loc[df["moeda"] == "R$"].copy()
-
 # Filtros globais (aplicados em ambas as páginas)
 # período (fim_vigencia) — mantém, mas você pode desligar se quiser
-min_date = df_brl["fim_vigencia"].min()
-max_date = df_brl["fim_vigencia"].max()
+# limites vêm das estatísticas das partições (sem concatenar a base)
+min_date = min((p["fim_min"] for p in partitions if pd.notna(p["fim_min"])), default=pd.NaT)
+max_date = max((p["fim_max"] for p in partitions if pd.notna(p["fim_max"])), default=pd.NaT)
 
 if pd.isna(min_date) or pd.isna(max_date):
     min_date = pd.Timestamp("2000-01-01")
@@ -198,7 +648,13 @@ date_range = st.sidebar.date_input(
     value=(min_date.date(), max_date.date()),
 )
 
-situacoes = sorted([s for s in df_brl["situacao"].dropna().unique().tolist() if s.strip() != ""])
+# poda de partições: fora do período não entram na base filtrada nem no merge
+# dos sketches (os frames ficam no cache_resource e não são tocados)
+sel_idx = podar_particoes(partitions, periodo_de(date_range))
+if len(partitions) > 1:
+    st.sidebar.caption(f"Partições no período: {len(sel_idx)} de {len(partitions)}")
+
+situacoes = sorted([s for s in set().union(*(p["situacoes"] for p in partitions)) if s.strip() != ""])
 situacao_sel = st.sidebar.multiselect(
     "Situação",
     options=situacoes,
@@ -207,26 +663,11 @@ situacao_sel = st.sidebar.multiselect(
 
 keyword_obj = st.sidebar.text_input("Buscar no objeto (palavra-chave)", value="")
 
-df_f = df_brl.copy()
+# preenchido pela página, depois de validar o drill contra o cubo do recorte
+drill_box = st.sidebar.container()
 
-# filtro datas
-if isinstance(date_range, tuple) and len(date_range) == 2:
-    d0 = pd.Timestamp(date_range[0])
-    d1 = pd.Timestamp(date_range[1]) + pd.Timedelta(days=1) - pd.Timedelta(seconds=1)
-    if "fim_vigencia" in df_f.columns:
-        df_f = df_f.loc[
-            (df_f["fim_vigencia"].notna())
-            & (df_f["fim_vigencia"] >= d0)
-            & (df_f["fim_vigencia"] <= d1)
-        ]
-
-# filtro situacao
-if situacao_sel:
-    df_f = df_f.loc[df_f["situacao"].isin(situacao_sel)]
-
-# filtro keyword no objeto
-if keyword_obj.strip():
-    df_f = df_f.loc[df_f["objeto"].str.contains(keyword_obj.strip(), case=False, na=False)]
+hoje = pd.Timestamp.today().date()
+filtros = (csv_url, assinatura, date_range, tuple(situacao_sel), keyword_obj.strip())
 
 # ===========================
 # PAGE 1 — VISÃO EXECUTIVA
@@ -235,25 +676,27 @@ if page == "Visão Global":
     # ---------------------------
     # KPIs
     # ---------------------------
-    today = pd.Timestamp.today()
-    valor_total = float(df_f["valor_contrato"].sum())
-    qtd_contratos = int(len(df_f))
-    qtd_fornecedores = int(df_f["fornecedor"].nunique(dropna=True))
+    ag = agregados_filtro(*filtros, "", hoje)
+    cube = ag["cube"]
+    drill_fornecedor, drill_ano = validar_drill(cube)
+    mostrar_drill(drill_box, drill_fornecedor, drill_ano)
+    cube_sel = cube_drill(cube, drill_fornecedor, drill_ano)   # KPIs e demais gráficos
+    cube_ano = cube_drill(cube, ano=drill_ano)                 # fig_valor (origem do drill de fornecedor)
+
+    valor_total = float(cube_sel["valor_total"].sum())
+    qtd_contratos = int(cube_sel["n"].sum())
+    if drill_fornecedor is None and drill_ano is None:
+        resumo = ag["resumo"]
+        sub_fornecedores = "Únicos"
+    else:
+        resumo = resumo_drill(ag, cube_sel, drill_fornecedor, drill_ano)
+        sub_fornecedores = "Únicos (seleção)"
+    qtd_fornecedores = resumo["fornecedores"] if qtd_contratos > 0 else 0
     ticket_medio = float(valor_total / qtd_contratos) if qtd_contratos > 0 else 0.0
 
     # vencendo em 90 dias (mantido, já que você já tem — NÃO é “página de risco”, é um KPI simples)
-    venc_90 = 0
-    if "fim_vigencia" in df_f.columns:
-        lim = today + pd.Timedelta(days=90)
-        venc_90 = int(df_f.loc[
-            df_f["fim_vigencia"].notna()
-            & (df_f["fim_vigencia"] >= today)
-            & (df_f["fim_vigencia"] <= lim)
-        ].shape[0])
-
-    ativos = 0
-    if "fim_vigencia" in df_f.columns:
-        ativos = int(df_f.loc[df_f["fim_vigencia"].notna() & (df_f["fim_vigencia"] >= today)].shape[0])
+    venc_90 = int(cube_sel["venc_90"].sum()) if "venc_90" in cube_sel.columns else 0
+    ativos = int(cube_sel["ativos"].sum()) if "ativos" in cube_sel.columns else 0
 
     c1, c2, c3, c4, c5, c6 = st.columns(6)
 
@@ -271,8 +714,9 @@ if page == "Visão Global":
 
     card(c1, "Valor Total (MM R$)", fmt_mm_pt(valor_total), "Somatório (BRL)")
     card(c2, "Contratos (#)", fmt_int_pt(qtd_contratos), "Contagem")
-    card(c3, "Fornecedores", fmt_int_pt(qtd_fornecedores), "Únicos")
-    card(c4, "Ticket médio (R$)", fmt_reais_pt(ticket_medio), "Valor/contrato")
+    card(c3, "Fornecedores", fmt_int_pt(qtd_fornecedores), sub_fornecedores)
+    card(c4, "Ticket médio (R$)", fmt_reais_pt(ticket_medio),
+         f"Mediana {fmt_reais_pt(resumo['ticket_p50'])} · P90 {fmt_reais_pt(resumo['ticket_p90'])}")
     card(c5, "Ativos hoje", fmt_int_pt(ativos), "Base: Dia atual")
     card(c6, "Vencem em 90 dias", fmt_int_pt(venc_90), "Próximo da expiração")
 
@@ -283,15 +727,16 @@ if page == "Visão Global":
     # ---------------------------
     left, right = st.columns([1, 1])
 
+    # gráfico de origem do drill: só o recorte de ano, para poder trocar de fornecedor
     top10_valor = (
-        df_f.groupby("fornecedor", dropna=False)["valor_contrato"]
-        .sum()
-        .sort_values(ascending=False)
+        agrega_fornecedor(cube_ano)[["fornecedor", "valor_total"]]
+        .rename(columns={"valor_total": "valor_contrato"})
+        .sort_values("valor_contrato", ascending=False)
         .head(10)
-        .reset_index()
+        .reset_index(drop=True)
     )
 
-    total_base = float(df_f["valor_contrato"].sum()) if len(df_f) else 0.0
+    total_base = float(cube_ano["valor_total"].sum()) if len(cube_ano) else 0.0
     if total_base > 0:
         top10_valor["participacao_%"] = (top10_valor["valor_contrato"] / total_base) * 100
     else:
@@ -316,16 +761,21 @@ if page == "Visão Global":
     fig_valor.update_traces(textposition="outside", cliponaxis=False)
 
     left.markdown("<div class='card'>", unsafe_allow_html=True)
-    left.plotly_chart(fig_valor, use_container_width=True)
+    left.plotly_chart(
+        fig_valor,
+        use_container_width=True,
+        key="sel_valor",
+        on_select=on_select_drill("sel_valor", "drill_fornecedor"),
+        selection_mode="points",
+    )
     left.markdown("</div>", unsafe_allow_html=True)
 
     top10_qtd = (
-        df_f.groupby("fornecedor", dropna=False)["sq_contrato"]
-        .count()
-        .sort_values(ascending=False)
+        agrega_fornecedor(cube_sel)[["fornecedor", "qtd"]]
+        .rename(columns={"qtd": "qtd_contratos"})
+        .sort_values("qtd_contratos", ascending=False)
         .head(10)
-        .reset_index()
-        .rename(columns={"sq_contrato": "qtd_contratos"})
+        .reset_index(drop=True)
     )
 
     fig_qtd = px.bar(
@@ -351,25 +801,8 @@ if page == "Visão Global":
     # ---------------------------
     # TABELA DETALHADA (TOP 10 POR VALOR) — ESQUERDA
     # ---------------------------
-    if "fim_vigencia" in df_f.columns:
-        det_valor = (
-            df_f.loc[df_f["fornecedor"].isin(top10_valor["fornecedor"])]
-            .groupby("fornecedor", dropna=False)
-            .agg(
-                valor_total=("valor_contrato", "sum"),
-                qtd=("sq_contrato", "count"),
-                ultimo_fim=("fim_vigencia", "max"),
-                primeiro_inicio=("inicio_vigencia", "min"),
-            )
-            .reset_index()
-        )
-    else:
-        det_valor = (
-            df_f.loc[df_f["fornecedor"].isin(top10_valor["fornecedor"])]
-            .groupby("fornecedor", dropna=False)
-            .agg(valor_total=("valor_contrato", "sum"), qtd=("sq_contrato", "count"))
-            .reset_index()
-        )
+    # acompanha o gráfico da esquerda (só recorte de ano)
+    det_valor = agrega_fornecedor(cube_ano.loc[cube_ano["fornecedor"].isin(top10_valor["fornecedor"])])
 
     det_valor = det_valor.sort_values("valor_total", ascending=False)
     det_valor["valor_total_MM"] = (
@@ -398,25 +831,7 @@ if page == "Visão Global":
     # ---------------------------
     # TABELA DETALHADA (TOP 10 POR QTD) — DIREITA
     # ---------------------------
-    if "fim_vigencia" in df_f.columns:
-        det_qtd = (
-            df_f.loc[df_f["fornecedor"].isin(top10_qtd["fornecedor"])]
-            .groupby("fornecedor", dropna=False)
-            .agg(
-                valor_total=("valor_contrato", "sum"),
-                qtd=("sq_contrato", "count"),
-                ultimo_fim=("fim_vigencia", "max"),
-                primeiro_inicio=("inicio_vigencia", "min"),
-            )
-            .reset_index()
-        )
-    else:
-        det_qtd = (
-            df_f.loc[df_f["fornecedor"].isin(top10_qtd["fornecedor"])]
-            .groupby("fornecedor", dropna=False)
-            .agg(valor_total=("valor_contrato", "sum"), qtd=("sq_contrato", "count"))
-            .reset_index()
-        )
+    det_qtd = agrega_fornecedor(cube_sel.loc[cube_sel["fornecedor"].isin(top10_qtd["fornecedor"])])
 
     det_qtd = det_qtd.sort_values("qtd", ascending=False)
     det_qtd["valor_total_MM"] = (
@@ -453,29 +868,13 @@ else:
 
     # “Categoria” aqui é um filtro por palavra-chave no objeto.
     # Você pode manter o texto livre (já tem) e adicionar presets rápidos.
-    presets = [
-        "(Nenhum preset)",
-        "transporte",
-        "manutenção",
-        "serviços",
-        "obra",
-        "engenharia",
-        "equipamento",
-        "tecnologia",
-        "software",
-        "licença",
-        "consultoria",
-        "turbina",
-        "bomba",
-        "válvula",
-    ]
+    presets = ["(Nenhum preset)"] + PRESETS_OBJETO
     preset = st.sidebar.selectbox("Preset de categoria (objeto)", options=presets, index=0)
     cat_text = st.sidebar.text_input("Categoria (texto livre no objeto)", value="")
 
     top_n_share = st.sidebar.slider("Top N para market share", min_value=5, max_value=30, value=10, step=1)
 
     # aplica filtro de “categoria” na base já filtrada globalmente
-    df_cat = df_f.copy()
     cat_query = ""
 
     if preset != "(Nenhum preset)":
@@ -485,8 +884,13 @@ else:
         # se usuário escrever algo, prioriza texto livre
         cat_query = cat_text.strip()
 
-    if cat_query:
-        df_cat = df_cat.loc[df_cat["objeto"].str.contains(cat_query, case=False, na=False)]
+    ag = agregados_filtro(*filtros, cat_query, hoje)
+    cube = ag["cube"]
+    drill_fornecedor, drill_ano = validar_drill(cube)
+    mostrar_drill(drill_box, drill_fornecedor, drill_ano)
+    cube_sel = cube_drill(cube, drill_fornecedor, drill_ano)   # KPIs e dispersão
+    cube_ano = cube_drill(cube, ano=drill_ano)                 # mercado do ano (share / CR)
+    cube_forn = cube_drill(cube, fornecedor=drill_fornecedor)  # fig_time (origem do drill de ano)
 
     # ---------------------------
     # KPIs “de mercado” (categoria)
@@ -498,9 +902,15 @@ else:
     )
     st.markdown("<div class='hr'></div>", unsafe_allow_html=True)
 
-    total_cat = float(df_cat["valor_contrato"].sum())
-    contratos_cat = int(len(df_cat))
-    fornecedores_cat = int(df_cat["fornecedor"].nunique(dropna=True))
+    total_cat = float(cube_sel["valor_total"].sum())
+    contratos_cat = int(cube_sel["n"].sum())
+    if drill_fornecedor is None and drill_ano is None:
+        resumo_cat = ag["resumo"]
+        sub_fornecedores = "fornecedores"
+    else:
+        resumo_cat = resumo_drill(ag, cube_sel, drill_fornecedor, drill_ano)
+        sub_fornecedores = "fornecedores (seleção)"
+    fornecedores_cat = resumo_cat["fornecedores"] if contratos_cat > 0 else 0
     ticket_cat = float(total_cat / contratos_cat) if contratos_cat > 0 else 0.0
 
     c1, c2, c3, c4 = st.columns(4)
@@ -519,21 +929,34 @@ else:
 
     card(c1, "Categoria (objeto)", cat_query if cat_query else "Sem recorte", "Filtro por palavra no objeto")
     card(c2, "Valor total (MM R$)", fmt_mm_pt(total_cat), "Somatório (categoria)")
-    card(c3, "Contratos (#)", fmt_int_pt(contratos_cat), "Contagem (categoria)")
-    card(c4, "Ticket médio (R$)", fmt_reais_pt(ticket_cat), "Valor/contrato (categoria)")
+    card(c3, "Contratos (#)", fmt_int_pt(contratos_cat), f"{fmt_int_pt(fornecedores_cat)} {sub_fornecedores}")
+    card(c4, "Ticket médio (R$)", fmt_reais_pt(ticket_cat),
+         f"Mediana {fmt_reais_pt(resumo_cat['ticket_p50'])} · P90 {fmt_reais_pt(resumo_cat['ticket_p90'])}")
+
+    # todos os presets de uma vez, direto dos sketches (sem str.contains por preset)
+    with st.expander("📋 Comparar presets de categoria"):
+        st.caption(
+            "Período e situação da sidebar; não considera texto livre nem drill. "
+            "Fornecedores, mediana e P90 são aproximados (HyperLogLog / sketch de quantis)."
+        )
+        t = resumo_presets(*filtros[:4])
+        t["Contratos (#)"] = t["Contratos (#)"].apply(fmt_int_pt)
+        t["Fornecedores (aprox.)"] = t["Fornecedores (aprox.)"].apply(fmt_int_pt)
+        t["Mediana (R$)"] = t["Mediana (R$)"].apply(fmt_reais_pt)
+        t["P90 (R$)"] = t["P90 (R$)"].apply(fmt_reais_pt)
+        st.dataframe(t, use_container_width=True, hide_index=True)
 
     st.markdown("<div class='hr'></div>", unsafe_allow_html=True)
 
     # ---------------------------
     # MARKET SHARE + CR4/CR10 + PARETO
     # ---------------------------
-    # share por fornecedor
+    # share por fornecedor — sempre sobre o mercado (recorte de ano), mesmo com
+    # drill de fornecedor: o share do selecionado continua relativo ao total
     share = (
-        df_cat.groupby("fornecedor", dropna=False)["valor_contrato"]
-        .sum()
-        .sort_values(ascending=False)
-        .reset_index()
-        .rename(columns={"valor_contrato": "valor_total"})
+        agrega_fornecedor(cube_ano)[["fornecedor", "valor_total"]]
+        .sort_values("valor_total", ascending=False)
+        .reset_index(drop=True)
     )
     base_val = float(share["valor_total"].sum()) if len(share) else 0.0
     share["share_%"] = (share["valor_total"] / base_val * 100) if base_val > 0 else 0.0
@@ -570,16 +993,28 @@ else:
     )
 
     a.markdown("<div class='card'>", unsafe_allow_html=True)
-    a.plotly_chart(fig_share, use_container_width=True)
+    a.plotly_chart(
+        fig_share,
+        use_container_width=True,
+        key="sel_share",
+        on_select=on_select_drill("sel_share", "drill_fornecedor"),
+        selection_mode="points",
+    )
     a.markdown("</div>", unsafe_allow_html=True)
 
     # Pareto (linha cumulativa) + barras (share)
+    # fica no mercado (o cumulativo só faz sentido com as barras anteriores);
+    # o fornecedor do drill é destacado
     pareto = share.head(max(top_n_share, 10)).copy()
+    cores_pareto = None
+    if drill_fornecedor is not None:
+        cores_pareto = ["#FFA15A" if f == drill_fornecedor else "#636EFA" for f in pareto["fornecedor"]]
     fig_pareto = go.Figure()
     fig_pareto.add_trace(go.Bar(
         x=pareto["fornecedor"],
         y=pareto["share_%"],
-        name="Share (%)"
+        name="Share (%)",
+        marker_color=cores_pareto,
     ))
     fig_pareto.add_trace(go.Scatter(
         x=pareto["fornecedor"],
@@ -615,12 +1050,8 @@ else:
     # SCATTER: VALOR vs QTD (fornecedores)
     # ---------------------------
     agg = (
-        df_cat.groupby("fornecedor", dropna=False)
-        .agg(
-            valor_total=("valor_contrato", "sum"),
-            qtd_contratos=("sq_contrato", "count")
-        )
-        .reset_index()
+        agrega_fornecedor(cube_sel)[["fornecedor", "valor_total", "qtd"]]
+        .rename(columns={"qtd": "qtd_contratos"})
     )
     agg["valor_MM"] = agg["valor_total"] / 1_000_000
 
@@ -647,20 +1078,14 @@ else:
     # ---------------------------
     # EVOLUÇÃO TEMPORAL (ano) — usando início de vigência
     # ---------------------------
-    df_time = df_cat.copy()
-    if "inicio_vigencia" in df_time.columns:
-        df_time["ano"] = df_time["inicio_vigencia"].dt.year
-    else:
-        df_time["ano"] = pd.NA
-
-    df_time = df_time.dropna(subset=["ano"])
+    # gráfico de origem do drill de ano: só o recorte de fornecedor
+    df_time = cube_forn.dropna(subset=["ano"])
     if len(df_time):
         serie = (
-            df_time.groupby("ano")["valor_contrato"]
+            df_time.groupby("ano")["valor_total"]
             .sum()
             .sort_index()
             .reset_index()
-            .rename(columns={"valor_contrato": "valor_total"})
         )
         serie["valor_MM"] = serie["valor_total"] / 1_000_000
 
@@ -681,7 +1106,13 @@ else:
         )
 
         st.markdown("<div class='card'>", unsafe_allow_html=True)
-        st.plotly_chart(fig_time, use_container_width=True)
+        st.plotly_chart(
+            fig_time,
+            use_container_width=True,
+            key="sel_time",
+            on_select=on_select_drill("sel_time", "drill_ano"),
+            selection_mode="points",
+        )
         st.markdown("</div>", unsafe_allow_html=True)
     else:
         st.info("Não há dados suficientes de 'inicio_vigencia' para montar a evolução temporal com o recorte atual.")